@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Adds counted topic views to topics.'
+
+    def handle(self, *args, **options):
+        from src.forum.models import Topic
+
+        views = Topic.objects.flush_views()
+        self.stdout.write('Views saved for %s topics' % len(views))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopicViewCounter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('shard', models.PositiveSmallIntegerField(verbose_name='shard')),
+                ('views', models.PositiveIntegerField(default=0, verbose_name='views count')),
+                ('topic', models.ForeignKey(related_name='view_counters', verbose_name='topic', to='forum.Topic')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='topicviewcounter',
+            unique_together=set([('topic', 'shard')]),
+        ),
+    ]
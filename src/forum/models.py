@@ -1,26 +1,41 @@
 # -*- coding: utf-8 -*-
+import random
 
 from django.conf import settings
 from django.contrib.auth.models import Group
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction, DatabaseError, IntegrityError
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 import markdown
 
-from src.forum.settings import FORUM_EDIT_TIMEOUT, POSTS_ON_PAGE
+from src.forum.settings import FORUM_EDIT_TIMEOUT, POSTS_ON_PAGE, FORUM_BUFFER_TOPIC_VIEWS, SHARED_CACHE
 from src.forum.util import urlize
 from src.utils.mail import send_templated_email
 
+STATISTIC_CACHE_KEY = 'forum_statistic'
+TOPIC_VIEWS_CACHE_KEY = 'forum_topic_views_%s'
+TOPIC_VIEWS_QUEUED_CACHE_KEY = 'forum_topic_views_queued_%s'
+TOPIC_VIEWS_QUEUED_TIMEOUT = 60 * 60
+TOPIC_VIEWS_QUEUE_CACHE_KEY = 'forum_topic_views_queue_%s_%s'
+TOPIC_VIEWS_QUEUE_LENGTH_CACHE_KEY = 'forum_topic_views_queue_length_%s'
+TOPIC_VIEWS_QUEUE_GENERATION_CACHE_KEY = 'forum_topic_views_queue_generation'
+TOPIC_VIEWS_FLUSH_BATCH_SIZE = 100
+TOPIC_VIEWS_SHARDS = 16
+
 
 class CategoryManager(models.Manager):
 
     def for_user(self, user):
         qs = super(CategoryManager, self).get_queryset()
-        return qs.filter(Q(groups=None) | Q(groups__user=user))
+        if not user.is_authenticated():
+            return qs.filter(groups=None)
+        return qs.filter(Q(groups=None) | Q(groups__user=user)).distinct()
 
 
 class Category(models.Model):
@@ -45,15 +60,16 @@ class Category(models.Model):
         return ('forum:index',)
 
     def has_access(self, user):
-        if self.groups.count() > 0:
-            if user.is_authenticated():
-                try:
-                    self.groups.get(user__pk=user.id)
-                except Group.DoesNotExist:
-                    return False
-            else:
-                return False
-        return True
+        # Forum, topic and post checks all end up here, so remember the
+        # result for this instance.
+        if not hasattr(self, '_access_cache'):
+            self._access_cache = {}
+
+        if user.pk not in self._access_cache:
+            self._access_cache[user.pk] = Category.objects.for_user(user) \
+                .filter(pk=self.pk).exists()
+
+        return self._access_cache[user.pk]
 
 
 class Forum(models.Model):
@@ -85,7 +101,8 @@ class Forum(models.Model):
     @property
     def last_post(self):
         try:
-            return Post.objects.filter(topic__forum=self).order_by('-created')[:1].get()
+            return Post.objects.filter(topic__forum=self).select_related('user', 'topic') \
+                .order_by('-created')[:1].get()
         except Post.DoesNotExist:
             pass
 
@@ -105,17 +122,8 @@ class Forum(models.Model):
         if not user.is_authenticated():
             return
 
-        now = timezone.now()
         unread_topics = Topic.objects.unread(user, self)
-
-        Visit.objects.filter(topic__id__in=[obj.pk for obj in unread_topics], user=user).update(time=now)
-
-        visits = []
-
-        for topic in Topic.objects.filter(pk__in=[obj.pk for obj in unread_topics]).exclude(visit__user=user):
-            visits.append(Visit(user=user, topic=topic, time=now))
-
-        Visit.objects.bulk_create(visits)
+        Visit.objects.mark_read(user, [obj.pk for obj in unread_topics])
 
     def has_access(self, user):
         return self.category.has_access(user)
@@ -125,6 +133,48 @@ class Forum(models.Model):
             and user.is_valid_email
 
 
+class VisitManager(models.Manager):
+
+    def mark_read(self, user, topic_ids):
+        """
+        Marks topics as visited by user now with one UPDATE for topics
+        visited before and one bulk INSERT for the rest. If some of the
+        rest get visited concurrently, falls back to saving them one by one.
+        """
+        if not topic_ids:
+            return
+
+        now = timezone.now()
+        qs = self.filter(user=user, topic__in=topic_ids)
+        visited_ids = set(qs.values_list('topic_id', flat=True))
+        qs.update(time=now)
+
+        new_ids = [topic_id for topic_id in topic_ids if topic_id not in visited_ids]
+
+        try:
+            with transaction.atomic():
+                self.bulk_create([
+                    self.model(user=user, topic_id=topic_id, time=now) for topic_id in new_ids
+                ])
+        except IntegrityError:
+            # Some topics were visited meanwhile
+            for topic_id in new_ids:
+                self.mark_visited(user, topic_id, now)
+
+    def mark_visited(self, user, topic_id, time):
+        # Repeated visits are the common case, so try a plain UPDATE first
+        # and insert only for the first visit.
+        if self.filter(user=user, topic_id=topic_id).update(time=time):
+            return
+
+        try:
+            with transaction.atomic():
+                self.create(user=user, topic_id=topic_id, time=time)
+        except IntegrityError:
+            # Concurrent request has just created the visit
+            self.filter(user=user, topic_id=topic_id).update(time=time)
+
+
 class Visit(models.Model):
     user = models.ForeignKey('accounts.User', verbose_name=_(u'user'), related_name='forum_visits')
     topic = models.ForeignKey('Topic', verbose_name=_(u'topic'))
@@ -133,9 +183,167 @@ class Visit(models.Model):
     class Meta:
         unique_together = ('user', 'topic')
 
+    objects = VisitManager()
+
+
+class TopicViewCounterManager(models.Manager):
+
+    def add_view(self, topic_id):
+        shard = random.randrange(TOPIC_VIEWS_SHARDS)
+        qs = self.filter(topic_id=topic_id, shard=shard)
+        if qs.update(views=models.F('views') + 1):
+            return
+
+        try:
+            with transaction.atomic():
+                self.create(topic_id=topic_id, shard=shard, views=1)
+        except IntegrityError:
+            # Concurrent request has just created the counter
+            qs.update(views=models.F('views') + 1)
+
+    def flush(self):
+        """
+        Adds counted views to Topic.views and resets the counters.
+        Returns dict of topic ids and added views.
+        """
+        topic_ids = sorted(set(self.filter(views__gt=0).values_list('topic_id', flat=True)))
+        views = {}
+
+        for i in range(0, len(topic_ids), TOPIC_VIEWS_FLUSH_BATCH_SIZE):
+            batch = topic_ids[i:i + TOPIC_VIEWS_FLUSH_BATCH_SIZE]
+
+            with transaction.atomic():
+                # Counters stay locked until the views are added to the
+                # topics, so no view is lost or added twice.
+                counters = list(self.select_for_update().filter(topic__in=batch, views__gt=0)
+                                .order_by('pk').values_list('pk', 'topic_id', 'views'))
+                batch_views = {}
+                for pk, topic_id, count in counters:
+                    batch_views[topic_id] = batch_views.get(topic_id, 0) + count
+
+                Topic.objects.increase_views(batch_views)
+                self.filter(pk__in=[pk for pk, topic_id, count in counters]).update(views=0)
+
+            views.update(batch_views)
+
+        return views
+
+
+class TopicViewCounter(models.Model):
+    """
+    Topic views not added to Topic.views yet. Views of a topic are spread
+    over TOPIC_VIEWS_SHARDS rows, so concurrent views neither wait for each
+    other nor lock the topic row.
+    """
+    topic = models.ForeignKey('Topic', verbose_name=_(u'topic'), related_name='view_counters')
+    shard = models.PositiveSmallIntegerField(_(u'shard'))
+    views = models.PositiveIntegerField(_(u'views count'), default=0)
+
+    class Meta:
+        unique_together = ('topic', 'shard')
+
+    objects = TopicViewCounterManager()
+
+
+def _cache_incr(key):
+    """
+    Increments counter in cache, creates it if missing. Returns new value.
+    """
+    if cache.add(key, 1, None):
+        return 1
+
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+        return 1
+
 
 class TopicManager(models.Manager):
 
+    def add_view(self, pk):
+        """
+        Counts topic view in TopicViewCounter, or in cache with
+        FORUM_BUFFER_TOPIC_VIEWS. Use flush_views to add counted views
+        to Topic.views.
+        """
+        if not FORUM_BUFFER_TOPIC_VIEWS:
+            TopicViewCounter.objects.add_view(pk)
+            return
+
+        _cache_incr(TOPIC_VIEWS_CACHE_KEY % pk)
+        self._queue_views(pk)
+
+    def _queue_views(self, pk):
+        # Every cache operation here is atomic: the topic is queued once
+        # until flush_views picks it up, in a slot taken from a counter of
+        # the current queue generation. The queued mark expires, so a topic
+        # whose slot got lost is queued again later and its views are
+        # still saved.
+        if cache.add(TOPIC_VIEWS_QUEUED_CACHE_KEY % pk, True, TOPIC_VIEWS_QUEUED_TIMEOUT):
+            generation = cache.get(TOPIC_VIEWS_QUEUE_GENERATION_CACHE_KEY, 0)
+            slot = _cache_incr(TOPIC_VIEWS_QUEUE_LENGTH_CACHE_KEY % generation)
+            cache.set(TOPIC_VIEWS_QUEUE_CACHE_KEY % (generation, slot), pk, None)
+
+    def flush_views(self):
+        """
+        Adds views counted by add_view to Topic.views. Topics are updated
+        in short batches in primary key order to keep row locks brief.
+        Returns dict of topic ids and added views.
+        """
+        views = TopicViewCounter.objects.flush()
+        for pk, count in self._flush_cached_views().items():
+            views[pk] = views.get(pk, 0) + count
+        return views
+
+    def _flush_cached_views(self):
+        # Switch add_view to a new queue and read the old one
+        generation = cache.get(TOPIC_VIEWS_QUEUE_GENERATION_CACHE_KEY, 0)
+        cache.set(TOPIC_VIEWS_QUEUE_GENERATION_CACHE_KEY, generation + 1, None)
+        length_key = TOPIC_VIEWS_QUEUE_LENGTH_CACHE_KEY % generation
+        slot_keys = [TOPIC_VIEWS_QUEUE_CACHE_KEY % (generation, slot)
+                     for slot in range(1, cache.get(length_key, 0) + 1)]
+        queued = set(cache.get_many(slot_keys).values())
+        cache.delete_many(slot_keys + [length_key])
+
+        views = {}
+        for pk in queued:
+            # Unmark first, so views counted from now on queue the topic again
+            cache.delete(TOPIC_VIEWS_QUEUED_CACHE_KEY % pk)
+            count = cache.get(TOPIC_VIEWS_CACHE_KEY % pk)
+            if count:
+                views[pk] = count
+
+        pks = sorted(views)
+        for i in range(0, len(pks), TOPIC_VIEWS_FLUSH_BATCH_SIZE):
+            batch = pks[i:i + TOPIC_VIEWS_FLUSH_BATCH_SIZE]
+            try:
+                self.increase_views(dict((pk, views[pk]) for pk in batch))
+            except DatabaseError:
+                # Keep views of this and the following batches counted and
+                # queued for the next flush
+                for pk in pks[i:]:
+                    self._queue_views(pk)
+                raise
+
+            # Saved, so take them off the counters
+            for pk in batch:
+                cache.decr(TOPIC_VIEWS_CACHE_KEY % pk, views[pk])
+
+        return views
+
+    def increase_views(self, views):
+        """
+        Adds views to topics with one UPDATE, views is a dict of topic ids
+        and view counts.
+        """
+        if not views:
+            return
+
+        cases = [models.When(pk=pk, then=models.Value(count)) for pk, count in views.items()]
+        self.filter(pk__in=views.keys()).update(
+            views=models.F('views') + models.Case(*cases, output_field=models.IntegerField()))
+
     def unread(self, user, forum):
         query = '''SELECT ft.* FROM forum_topic ft LEFT JOIN forum_visit fv ON ft.id = fv.topic_id AND fv.user_id = %s
 WHERE ft.forum_id = %s AND (fv.time IS NULL OR fv.time < ft.updated);'''
@@ -173,9 +381,41 @@ class RatingMixin(object):
     def has_vote(self, user):
         return self.votes.filter(pk=user.pk).exists()
 
+    def toggle_vote(self, user):
+        """
+        Adds user's vote or removes it if it already exists.
+        Returns True if the vote was added.
+        """
+        through = self.votes.through
+        lookup = {
+            self.votes.source_field_name: self,
+            self.votes.target_field_name: user
+        }
+
+        rating_qs = type(self).objects.filter(pk=self.pk)
+
+        try:
+            with transaction.atomic():
+                through.objects.create(**lookup)
+                rating_qs.update(rating=models.F('rating') + 1)
+            voted = True
+        except IntegrityError:
+            with transaction.atomic():
+                # Lock the vote, so a concurrent unvote waits for this one
+                # and then finds nothing to delete.
+                vote_ids = list(through.objects.select_for_update()
+                                .filter(**lookup).values_list('pk', flat=True))
+                if vote_ids:
+                    through.objects.filter(pk__in=vote_ids).delete()
+                    rating_qs.update(rating=models.F('rating') - 1)
+            voted = False
+
+        self.refresh_from_db(fields=['rating'])
+        return voted
+
     def update_rating(self):
         self.rating = self.votes.count()
-        self.save()
+        type(self).objects.filter(pk=self.pk).update(rating=self.rating)
 
 
 class Topic(models.Model, RatingMixin):
@@ -218,31 +458,34 @@ class Topic(models.Model, RatingMixin):
 
     @property
     def reply_count(self):
-        return self.posts.all().count() - 1
+        # Topic lists annotate posts_count to avoid a query per topic
+        if not hasattr(self, 'posts_count'):
+            self.posts_count = self.posts.all().count()
+        return self.posts_count - 1
 
     def mark_heresy(self):
         self.heresy = True
-        self.save()
+        self.save(update_fields=['heresy'])
 
     def unmark_heresy(self):
         self.heresy = False
-        self.save()
+        self.save(update_fields=['heresy'])
 
     def stick(self):
         self.sticky = True
-        self.save()
+        self.save(update_fields=['sticky'])
 
     def unstick(self):
         self.sticky = False
-        self.save()
+        self.save(update_fields=['sticky'])
 
     def close(self):
         self.closed = True
-        self.save()
+        self.save(update_fields=['closed'])
 
     def open(self):
         self.closed = False
-        self.save()
+        self.save(update_fields=['closed'])
 
     def can_delete(self, user):
         return user.is_active and user.is_superuser
@@ -263,24 +506,15 @@ class Topic(models.Model, RatingMixin):
     @property
     def last_post(self):
         try:
-            return Post.objects.filter(topic=self).order_by('-created')[:1].get()
+            return self.posts.select_related('user').order_by('-created')[:1].get()
         except Post.DoesNotExist:
             pass
 
     def mark_visited_for(self, user):
         if not user.is_authenticated():
-            return None
-
-        now = timezone.now()
-        visit, created = Visit.objects.get_or_create(user=user, topic=self, defaults={
-            'time': now
-        })
-
-        if not created:
-            visit.time = now
-            visit.save()
+            return
 
-        return visit
+        Visit.objects.mark_visited(user, self.pk, timezone.now())
 
     def has_unread(self, user):
         # Do not track for anonymous users
@@ -330,7 +564,7 @@ class Post(models.Model, RatingMixin):
     def save(self, *args, **kwargs):
         super(Post, self).save(*args, **kwargs)
         self.topic.updated = self.updated or self.created
-        self.topic.save()
+        self.topic.save(update_fields=['updated'])
 
     def delete(self):
         topic = self.topic
@@ -383,3 +617,15 @@ class Post(models.Model, RatingMixin):
 
     def has_access(self, user):
         return self.topic.has_access(user)
+
+
+def reset_statistic_cache(sender, **kwargs):
+    cache.delete(STATISTIC_CACHE_KEY)
+
+# With a per-process cache the delete would only reach the process that
+# saved the object, so the statistic just expires by its timeout there.
+if SHARED_CACHE:
+    post_save.connect(reset_statistic_cache, Topic)
+    post_save.connect(reset_statistic_cache, Post)
+    post_delete.connect(reset_statistic_cache, Topic)
+    post_delete.connect(reset_statistic_cache, Post)
@@ -2,7 +2,21 @@
 # -*- coding: utf-8 -*-
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 
 POSTS_ON_PAGE = getattr(settings, 'FORUM_POSTS_ON_PAGE', 50)
 FORUM_EDIT_TIMEOUT = getattr(settings, 'FORUM_EDIT_TIMEOUT', 60)
+
+# Whether cache changes made by one process are seen by the others
+SHARED_CACHE = settings.CACHES['default']['BACKEND'] not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache')
+
+# Count topic views in cache and save them to database with the
+# flush_topic_views command. Needs a cache shared by all processes.
+FORUM_BUFFER_TOPIC_VIEWS = getattr(settings, 'FORUM_BUFFER_TOPIC_VIEWS', False)
+
+if FORUM_BUFFER_TOPIC_VIEWS and not SHARED_CACHE:
+    raise ImproperlyConfigured('FORUM_BUFFER_TOPIC_VIEWS requires a cache shared '
+                               'between processes, e.g. memcached.')
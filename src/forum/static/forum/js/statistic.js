@@ -0,0 +1,22 @@
+jQuery(function($) {
+    $('.js-posts-per-month-chart').each(function() {
+        var $canvas = $(this);
+
+        $.getJSON($canvas.data('url'), function(data) {
+            new Chart($canvas, {
+                type: 'bar',
+                data: {
+                    labels: data.labels,
+                    datasets: [{
+                        label: $canvas.data('label'),
+                        data: data.values,
+                        backgroundColor: '#7dc855'
+                    }]
+                },
+                options: {
+                    legend: {display: false}
+                }
+            });
+        });
+    });
+});
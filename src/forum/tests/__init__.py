@@ -0,0 +1 @@
+from .tests import *
\ No newline at end of file
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import mock
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import TestCase
+
+from src.accounts.tests.factories import UserFactory
+from src.forum.models import Category, Forum, Topic, TopicViewCounter
+from src.forum.models import TOPIC_VIEWS_QUEUE_CACHE_KEY, TOPIC_VIEWS_QUEUED_CACHE_KEY
+
+
+class TopicViewsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        user = UserFactory()
+        forum = Forum.objects.create(category=Category.objects.create(name='category'), name='forum')
+        self.topic = Topic.objects.create(forum=forum, user=user, name='topic')
+        self.other_topic = Topic.objects.create(forum=forum, user=user, name='other topic')
+
+    def tearDown(self):
+        cache.clear()
+
+    def get_views(self, topic):
+        return Topic.objects.get(pk=topic.pk).views
+
+    def test_add_view_without_buffer(self):
+        with mock.patch('src.forum.models.random.randrange', side_effect=[0, 1, 1]):
+            Topic.objects.add_view(self.topic.pk)
+            Topic.objects.add_view(self.topic.pk)
+            Topic.objects.add_view(self.topic.pk)
+        self.assertEqual(TopicViewCounter.objects.filter(topic=self.topic).count(), 2)
+        self.assertEqual(self.get_views(self.topic), 0)
+
+        self.assertEqual(Topic.objects.flush_views(), {self.topic.pk: 3})
+        self.assertEqual(self.get_views(self.topic), 3)
+        self.assertFalse(TopicViewCounter.objects.filter(views__gt=0).exists())
+
+        # counters are reused after flush
+        Topic.objects.add_view(self.topic.pk)
+        self.assertEqual(Topic.objects.flush_views(), {self.topic.pk: 1})
+        self.assertEqual(self.get_views(self.topic), 4)
+
+    @mock.patch('src.forum.models.FORUM_BUFFER_TOPIC_VIEWS', True)
+    def test_flush_views(self):
+        Topic.objects.add_view(self.topic.pk)
+        Topic.objects.add_view(self.topic.pk)
+        Topic.objects.add_view(self.other_topic.pk)
+        self.assertEqual(self.get_views(self.topic), 0)
+
+        views = Topic.objects.flush_views()
+        self.assertEqual(views, {self.topic.pk: 2, self.other_topic.pk: 1})
+        self.assertEqual(self.get_views(self.topic), 2)
+        self.assertEqual(self.get_views(self.other_topic), 1)
+
+        # nothing new to save
+        self.assertEqual(Topic.objects.flush_views(), {})
+        self.assertEqual(self.get_views(self.topic), 2)
+
+    @mock.patch('src.forum.models.FORUM_BUFFER_TOPIC_VIEWS', True)
+    def test_views_after_flush_are_queued_again(self):
+        Topic.objects.add_view(self.topic.pk)
+        Topic.objects.flush_views()
+
+        Topic.objects.add_view(self.topic.pk)
+        self.assertEqual(Topic.objects.flush_views(), {self.topic.pk: 1})
+        self.assertEqual(self.get_views(self.topic), 2)
+
+    @mock.patch('src.forum.models.FORUM_BUFFER_TOPIC_VIEWS', True)
+    def test_cache_restart(self):
+        Topic.objects.add_view(self.topic.pk)
+        Topic.objects.flush_views()
+        Topic.objects.add_view(self.topic.pk)
+
+        cache.clear()
+        Topic.objects.add_view(self.other_topic.pk)
+        self.assertEqual(Topic.objects.flush_views(), {self.other_topic.pk: 1})
+
+    @mock.patch('src.forum.models.FORUM_BUFFER_TOPIC_VIEWS', True)
+    def test_lost_queue_slot(self):
+        Topic.objects.add_view(self.topic.pk)
+        cache.delete(TOPIC_VIEWS_QUEUE_CACHE_KEY % (0, 1))
+        self.assertEqual(Topic.objects.flush_views(), {})
+
+        # the topic is queued again once its queued mark expires
+        cache.delete(TOPIC_VIEWS_QUEUED_CACHE_KEY % self.topic.pk)
+        Topic.objects.add_view(self.topic.pk)
+        self.assertEqual(Topic.objects.flush_views(), {self.topic.pk: 2})
+
+    @mock.patch('src.forum.models.FORUM_BUFFER_TOPIC_VIEWS', True)
+    def test_failed_flush_keeps_views(self):
+        Topic.objects.add_view(self.topic.pk)
+        Topic.objects.add_view(self.other_topic.pk)
+
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, Topic.objects.flush_views)
+
+        self.assertEqual(self.get_views(self.topic), 0)
+        self.assertEqual(Topic.objects.flush_views(), {self.topic.pk: 1, self.other_topic.pk: 1})
+        self.assertEqual(self.get_views(self.topic), 1)
+        self.assertEqual(self.get_views(self.other_topic), 1)
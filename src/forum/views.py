@@ -1,47 +1,55 @@
 # -*- coding: utf-8 -*-
-import pygal
-from pygal.style import LightGreenStyle
-
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.cache import cache
-from django.db.models import F, Sum, Count
-from django.http import Http404, HttpResponse
+from django.db.models import Sum, Count, Min
+from django.http import Http404
 from django.shortcuts import get_object_or_404, redirect
 from django.utils.translation import ugettext_lazy as _, ugettext
 from django.utils.timezone import now
+from django.views.decorators.cache import cache_control
 from django.views.generic.list import ListView
 
 from src.accounts.models import User
 from src.decorators import render_to
 from src.forum.forms import AddTopicForm, AddPostForm
 from src.forum.forms import EditPostForm, MoveTopicForm
-from src.forum.models import Category, Forum, Topic, Post
+from src.forum.models import Category, Forum, Topic, Post, Visit
+from src.forum.models import STATISTIC_CACHE_KEY
 from src.forum.settings import POSTS_ON_PAGE
+from src.utils.db.functions import Extract
 from src.utils.views import JsonResponse, object_list
 
 
 @render_to('djforum/index.html')
 def index(request):
     users_cached = cache.get('users_online', {})
-    users_online = users_cached and User.objects.filter(
-        id__in=users_cached.keys()) or []
+    users_online = users_cached and list(User.objects.filter(
+        id__in=users_cached.keys()).only('username')) or []
     guests_cached = cache.get('guests_online', {})
     guest_count = len(guests_cached)
     users_count = len(users_online)
 
-    categories = [obj for obj in Category.objects.all()
-                  if obj.has_access(request.user)]
+    categories = Category.objects.for_user(request.user) \
+        .prefetch_related('forums')
 
-    return {
+    counts = cache.get('forum_global_counts')
+    if counts is None:
+        counts = {
+            'users_count': User.objects.count(),
+            'topics_count': Topic.objects.count(),
+            'posts_count': Post.objects.count()
+        }
+        cache.set('forum_global_counts', counts, 60)
+
+    context = {
         'categories': categories,
         'users_online': users_online,
         'online_count': users_count,
-        'guest_count': guest_count,
-        'users_count': User.objects.count(),
-        'topics_count': Topic.objects.count(),
-        'posts_count': Post.objects.count()
+        'guest_count': guest_count
     }
+    context.update(counts)
+    return context
 
 
 @render_to('djforum/forum.html')
@@ -51,7 +59,7 @@ def forum(request, pk):
     if not forum_obj.has_access(request.user):
         raise Http404
 
-    qs = forum_obj.topics.all()
+    qs = forum_obj.topics.annotate(posts_count=Count('posts'))
     extra_context = {
         'forum': forum_obj
     }
@@ -65,13 +73,10 @@ class UnreadView(ListView):
     template_name = 'djforum/unread_topics.html'
 
     def get_queryset(self):
-        return Topic.objects.unread_for_user(user=self.request.user)
-
-    def get_paginator(self, *args, **kwargs):
-        paginator = super(UnreadView, self).get_paginator(*args, **kwargs)
-        paginator._count = Topic.objects.unread_for_user_count(
-            user=self.request.user)
-        return paginator
+        # Slicing a raw queryset fetches all its rows anyway, so fetch them
+        # once and let the paginator count the list instead of issuing a
+        # separate COUNT query.
+        return list(Topic.objects.unread_for_user(user=self.request.user))
 
 unread_topics = login_required(UnreadView.as_view())
 
@@ -177,9 +182,9 @@ def edit_post(request, pk):
 def unsubscribe(request, pk):
     topic = get_object_or_404(Topic, pk=pk)
 
-    if topic.user == request.user:
+    if topic.user_id == request.user.pk:
         topic.send_response = False
-        topic.save()
+        topic.save(update_fields=['send_response'])
 
     return redirect(topic)
 
@@ -188,9 +193,9 @@ def unsubscribe(request, pk):
 def subscribe(request, pk):
     topic = get_object_or_404(Topic, pk=pk)
 
-    if topic.user == request.user:
+    if topic.user_id == request.user.pk:
         topic.send_response = True
-        topic.save()
+        topic.save(update_fields=['send_response'])
 
     return redirect(topic)
 
@@ -247,24 +252,23 @@ def delete_topic(request, pk):
 
 @login_required
 def delete_post(request, pk):
-    post = get_object_or_404(Post, pk=pk)
+    post = get_object_or_404(Post.objects.select_related('topic__forum'), pk=pk)
     topic_id = post.topic_id
     forum = post.topic.forum
 
     if post.can_delete(request.user):
         post.delete()
 
-    try:
-        return redirect(Topic.objects.get(pk=topic_id))
-    except Topic.DoesNotExist:
-        return redirect(forum)
+        if not Topic.objects.filter(pk=topic_id).exists():
+            return redirect(forum)
+
+    return redirect('forum:topic', topic_id)
 
 
 @login_required
 def mark_read_all(request):
-    for forum in Forum.objects.all():
-        if forum.has_access(request.user):
-            forum.mark_read(request.user)
+    unread_topics = Topic.objects.unread_for_user(request.user)
+    Visit.objects.mark_read(request.user, [obj.pk for obj in unread_topics])
     return redirect('forum:index')
 
 
@@ -280,13 +284,14 @@ def mark_read_forum(request, pk):
 
 def topic(request, pk):
     user = request.user
-    topic = get_object_or_404(Topic, pk=pk)
+    topic = get_object_or_404(Topic.objects.select_related('forum__category'), pk=pk)
+    has_access = topic.has_access(user)
 
-    if not topic.has_access(user):
+    if not has_access:
         raise Http404
 
-    Topic.objects.filter(pk=pk).update(views=F('views') + 1)
-    qs = topic.posts.all()
+    Topic.objects.add_view(topic.pk)
+    qs = topic.posts.select_related('user', 'updated_by')
     form = None
 
     if topic.can_post(user):
@@ -298,7 +303,7 @@ def topic(request, pk):
         'form': form,
         'forum': topic.forum,
         'topic': topic,
-        'has_access': topic.has_access(user)
+        'has_access': has_access
     }
     return object_list(request, qs, POSTS_ON_PAGE,
                        template_name='djforum/topic.html',
@@ -317,14 +322,7 @@ def vote(request, pk, model):
     if not obj.has_access(user):
         raise Http404
 
-    if obj.votes.filter(pk=user.pk).exists():
-        obj.votes.remove(user)
-        voted = False
-    else:
-        obj.votes.add(user)
-        voted = True
-
-    obj.update_rating()
+    voted = obj.toggle_vote(user)
 
     return JsonResponse({
         'rating': obj.rating,
@@ -334,39 +332,60 @@ def vote(request, pk, model):
 
 @render_to('djforum/statistic.html')
 def statistic(request):
-    most_active_users = User.objects.annotate(Count('forum_posts')) \
-        .order_by('-forum_posts__count')[:10]
-    most_topics_users = User.objects.annotate(Count('forum_topics')) \
-        .order_by('-forum_topics__count')[:10]
-
-    return {
+    context = cache.get(STATISTIC_CACHE_KEY)
+    if context is not None:
+        return context
+
+    # Group the posts and topics tables by author and fetch all the top
+    # users at once instead of joining them to the whole users table twice.
+    top_posters = Post.objects.values_list('user').annotate(Count('id')) \
+        .order_by('-id__count')[:10]
+    top_topic_starters = Topic.objects.values_list('user').annotate(Count('id')) \
+        .order_by('-id__count')[:10]
+    top_posters, top_topic_starters = list(top_posters), list(top_topic_starters)
+    users = User.objects.in_bulk(
+        set(user_id for user_id, count in top_posters + top_topic_starters))
+
+    most_active_users = []
+    for user_id, count in top_posters:
+        users[user_id].forum_posts__count = count
+        most_active_users.append(users[user_id])
+
+    most_topics_users = []
+    for user_id, count in top_topic_starters:
+        users[user_id].forum_topics__count = count
+        most_topics_users.append(users[user_id])
+
+    topics = Topic.objects.aggregate(Count('id'), Sum('views'))
+
+    context = {
         'active_users_count': User.objects.exclude(forum_posts=None).count(),
-        'topics_count': Topic.objects.count(),
+        'topics_count': topics['id__count'],
         'posts_count': Post.objects.count(),
-        'first_post_created': Post.objects.order_by('created')[0].created,
-        'views_count': Topic.objects.aggregate(Sum('views'))['views__sum'],
-        'most_viewed_topics': Topic.objects.order_by('-views')[:10],
+        'first_post_created': Post.objects.aggregate(Min('created'))['created__min'],
+        'views_count': topics['views__sum'],
+        'most_viewed_topics': list(Topic.objects.order_by('-views')[:10]),
         'most_active_users': most_active_users,
         'most_topics_users': most_topics_users
     }
+    cache.set(STATISTIC_CACHE_KEY, context, 60 * 5)
+    return context
+
+
+@cache_control(max_age=60 * 60)
+def posts_per_month(request):
+    data = cache.get('forum_posts_per_month')
+
+    if data is None:
+        posts_per_month = Post.objects \
+            .annotate(year=Extract('created', 'year'), month=Extract('created', 'month')) \
+            .values('year', 'month').annotate(Count('id')) \
+            .order_by('year', 'month')
 
+        data = {
+            'labels': ['%s.%s' % (item['month'], item['year']) for item in posts_per_month],
+            'values': [item['id__count'] for item in posts_per_month]
+        }
+        cache.set('forum_posts_per_month', data, 60 * 60)
 
-def posts_per_month_chart(request):
-    posts_per_month = Post.objects \
-        .extra(select={'year': "EXTRACT(year FROM created)",
-               'month': "EXTRACT(month from created)"}) \
-        .values('year', 'month').annotate(Count('id')) \
-        .order_by('year', 'month')
-
-    posts_per_month_chart = pygal.Bar(show_legend=False, style=LightGreenStyle, x_label_rotation=45)
-    posts_per_month_chart.title = ugettext('Posts per month')
-    posts_per_month_chart.x_labels = \
-        ['%s.%s' % (item['month'], item['year']) for item in posts_per_month]
-
-    data = [{
-        'value': item['id__count'],
-        'label': '%s.%s' % (item['month'], item['year'])
-    } for item in posts_per_month]
-    posts_per_month_chart.add(ugettext('Posts count'), data)
-    content = posts_per_month_chart.render()
-    return HttpResponse(content, content_type='image/svg+xml')
+    return JsonResponse(data)
@@ -0,0 +1,15 @@
+from django.db.models import Func, IntegerField
+
+
+class Extract(Func):
+    """
+    EXTRACT(<lookup_name> FROM <expression>), e.g. Extract('created', 'year').
+
+    Remove in favour of django.db.models.functions.Extract after upgrading
+    to Django 1.10.
+    """
+    template = 'EXTRACT(%(lookup_name)s FROM %(expressions)s)'
+
+    def __init__(self, expression, lookup_name, **extra):
+        extra.setdefault('output_field', IntegerField())
+        super(Extract, self).__init__(expression, lookup_name=lookup_name.upper(), **extra)